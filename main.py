@@ -1,53 +1,216 @@
 """
 FastAPI Web UI for the X Automation Agent.
 """
-from fastapi import FastAPI, Form, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import Depends, FastAPI, Form, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from starlette.exceptions import HTTPException as StarletteHTTPException
 import uvicorn
-from typing import List
+from typing import List, Optional, Set
+import asyncio
+import collections
+import logging
+import logging.handlers
+import queue
 import re
-import traceback
-from src.agent import Agent
+import threading
+from src.agent import Agent, Post
 from src.config import Config
 from src.database import Database
-import threading
 
-app = FastAPI(title="X Automation Agent")
+app = FastAPI(title="X Automation Agent", default_response_class=ORJSONResponse)
 templates = Jinja2Templates(directory="templates")
 
+# Post-link parser patterns, compiled once instead of on every /run
+LINK_RE = re.compile(r'https?://(?:twitter|x)\.com/[^ \n\r\t]+(?:/status/\d+)?(?:(?:\?|#)\S+)?|https?://t\.co/\S+')
+GROKISM_RE = re.compile(r'(?:ne )?post (?:kiya|ha?i):?\s*', re.IGNORECASE)
+
+# ============================================================
+# LOGGING — records are queued and formatted/written on a listener
+# thread, so logging a traceback never blocks the event loop
+# ============================================================
+logger = logging.getLogger(__name__)
+log_queue_handler: Optional[logging.Handler] = None
+log_listener: Optional[logging.handlers.QueueListener] = None
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting (including tracebacks) to the listener thread."""
+    def prepare(self, record):
+        return record
+
+@app.on_event("startup")
+async def start_log_listener():
+    """Route root logging through a queue drained by a background thread."""
+    global log_queue_handler, log_listener
+    log_queue = queue.Queue(-1)
+    log_queue_handler = DeferredQueueHandler(log_queue)
+    logging.getLogger().addHandler(log_queue_handler)
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    log_listener.start()
+
+@app.on_event("shutdown")
+async def stop_log_listener():
+    """Flush queued log records and detach the queue handler."""
+    if log_listener:
+        log_listener.stop()
+    if log_queue_handler:
+        logging.getLogger().removeHandler(log_queue_handler)
+
 # ============================================================
 # GLOBAL ERROR HANDLER — ensures ALL errors return valid JSON
 # ============================================================
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request, exc):
-    return JSONResponse(
+    return ORJSONResponse(
         {"status": "error", "message": str(exc.detail)},
         status_code=exc.status_code
     )
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
-    traceback.print_exc()
-    return JSONResponse(
+    logger.error("Unhandled error on %s %s", request.method, request.url.path, exc_info=exc)
+    return ORJSONResponse(
         {"status": "error", "message": f"Internal server error: {str(exc)}"},
         status_code=500
     )
 
-# Global agent instance
-agent = Agent()
-db = Database()
+# Shared instances, created on first use so importing/starting the app stays cheap.
+# The agent reuses the UI's Database so the cached daily count stays in sync.
+# Depends() resolves these in the threadpool while other handlers call them on the
+# event loop, so creation is locked to guarantee a single instance of each.
+_db: Optional[Database] = None
+_agent: Optional[Agent] = None
+_instances_lock = threading.RLock()
+
+def get_db() -> Database:
+    global _db
+    if _db is None:
+        with _instances_lock:
+            if _db is None:
+                _db = Database()
+    return _db
 
-# Session status (for async tracking)
+def get_agent() -> Agent:
+    global _agent
+    if _agent is None:
+        with _instances_lock:
+            if _agent is None:
+                _agent = Agent(db=get_db())
+    return _agent
+
+@app.on_event("shutdown")
+async def close_database():
+    """Close the LLM client and the shared SQLite connection (checkpoints the WAL) on exit."""
+    global _db, _agent
+    with _instances_lock:
+        agent, db = _agent, _db
+        _agent = _db = None
+    if agent is not None:
+        await asyncio.to_thread(agent.llm.close)  # Runs its own event loop
+    if db is not None:
+        db.close()
+
+# Session status (for async tracking).
+# Only touched from the event loop: the worker thread reports through progress_queue.
 session_status = {
     "running": False,
     "progress": "",
     "report": None,
-    "progress_log": []
+    "progress_log": collections.deque(maxlen=200)  # Bounded: oldest lines drop off
 }
 
+def log_tail(n: int = 50) -> List[str]:
+    """The last n progress lines as a JSON-serializable list."""
+    return list(session_status["progress_log"])[-n:]
+
+def append_progress(msg: str) -> List[str]:
+    """Append a progress line and return the last 50 lines."""
+    session_status["progress_log"].append(msg)
+    session_status["progress"] = msg
+    return log_tail()
+
+# Live status push — connected /ws/status clients, the server event loop,
+# the queue the worker thread posts progress to, and strong references to the
+# background tasks (the loop itself only keeps weak ones)
+ws_clients: Set[WebSocket] = set()
+ws_clients_lock = asyncio.Lock()
+main_loop: Optional[asyncio.AbstractEventLoop] = None
+progress_queue: Optional[asyncio.Queue] = None
+broadcaster_task: Optional[asyncio.Task] = None
+session_task: Optional[asyncio.Task] = None
+# Held from /run until the session task finishes — one automation session at a time
+session_lock = asyncio.Lock()
+
+def status_snapshot() -> dict:
+    """Current session status as a WebSocket message (log trimmed to the last 50 lines)."""
+    return {
+        "type": "status",
+        "running": session_status["running"],
+        "progress": session_status["progress"],
+        "report": session_status["report"],
+        "log": log_tail()
+    }
+
+async def broadcast(payload: dict):
+    """Send a payload to every connected WebSocket client, dropping dead sockets."""
+    async with ws_clients_lock:
+        dead = []
+        for ws in ws_clients:
+            try:
+                await ws.send_json(payload)
+            except Exception:
+                dead.append(ws)
+        for ws in dead:
+            ws_clients.discard(ws)
+
+async def progress_broadcaster():
+    """Drain progress messages from the worker into session_status and WebSocket clients."""
+    while True:
+        msg = await progress_queue.get()
+        try:
+            tail = append_progress(msg)
+            await broadcast({"type": "progress", "progress": msg, "log": tail})
+        finally:
+            progress_queue.task_done()
+
+def post_progress(msg: str):
+    """Progress callback for the worker thread — hands the message to the event loop."""
+    main_loop.call_soon_threadsafe(progress_queue.put_nowait, msg)
+
+@app.on_event("startup")
+async def start_progress_broadcaster():
+    """Capture the server loop and start consuming worker progress."""
+    global main_loop, progress_queue, broadcaster_task
+    main_loop = asyncio.get_running_loop()
+    progress_queue = asyncio.Queue()
+    broadcaster_task = asyncio.create_task(progress_broadcaster())
+
+async def run_session_task(agent: Agent, session_data: List[Post], target_count: int):
+    """Run the blocking agent session on a pooled worker thread and record the outcome."""
+    try:
+        error = None
+        try:
+            report = await asyncio.to_thread(agent.run_session, session_data, target_count, post_progress)
+        except Exception as e:
+            error = e
+        # Deliver all queued progress first, so it can't overwrite or follow the final status
+        await progress_queue.join()
+        if error is not None:
+            session_status.update(report={
+                "status": "error",
+                "message": str(error)
+            })
+            append_progress(f"❌ Error: {str(error)}")
+        elif report.get("status") == "stopped":
+            session_status.update(report=report, progress="🛑 Stopped by user")
+        else:
+            session_status.update(report=report, progress="Completed!")
+    finally:
+        session_status.update(running=False)
+        session_lock.release()
+        await broadcast(status_snapshot())
+
 DEFAULT_GROK_PROMPT = """mujhe in account se post do (post link + text version of post). 
 jo abhi abhi 1 hour m post ki gyi ho. 
 
@@ -116,7 +279,7 @@ jo abhi abhi 1 hour m post ki gyi ho.
 @Yongfook"""
 
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
+async def home(request: Request, db: Database = Depends(get_db)):
     """Render the main UI page."""
     today_count = db.get_today_reply_count()
     remaining = Config.DAILY_REPLY_LIMIT - today_count
@@ -134,159 +297,162 @@ async def home(request: Request):
     })
 
 @app.post("/save_prompt")
-async def save_prompt(prompt: str = Form(...)):
+async def save_prompt(prompt: str = Form(...), db: Database = Depends(get_db)):
     """Save the Grok prompt to the database, sanitizing it for HTML safety."""
     try:
         clean_prompt = prompt.replace("</textarea>", "").replace("<textarea>", "")
         db.set_setting("grok_prompt", clean_prompt)
-        return JSONResponse({"status": "success", "message": "✅ Prompt saved successfully!"})
+        return ORJSONResponse({"status": "success", "message": "✅ Prompt saved successfully!"})
     except Exception as e:
-        return JSONResponse({"status": "error", "message": f"Save failed: {str(e)}"}, status_code=500)
+        return ORJSONResponse({"status": "error", "message": f"Save failed: {str(e)}"}, status_code=500)
 
 @app.post("/reset_prompt")
-async def reset_prompt():
+async def reset_prompt(db: Database = Depends(get_db)):
     """Reset the Grok prompt to the default."""
     try:
         db.set_setting("grok_prompt", DEFAULT_GROK_PROMPT)
-        return JSONResponse({"status": "success", "message": "✅ Prompt reset to default!"})
+        return ORJSONResponse({"status": "success", "message": "✅ Prompt reset to default!"})
     except Exception as e:
-        return JSONResponse({"status": "error", "message": f"Reset failed: {str(e)}"}, status_code=500)
+        return ORJSONResponse({"status": "error", "message": f"Reset failed: {str(e)}"}, status_code=500)
 
 @app.post("/run")
 async def run_automation(
     post_urls: str = Form(...),
-    target_count: int = Form(None)
+    target_count: int = Form(None),
+    agent: Agent = Depends(get_agent)
 ):
     """Run the automation with given post URLs and optional target count."""
-    global session_status
+    global session_task
     
     try:
         # If no target count provided, default to a high number to process all provided
         if target_count is None:
             target_count = 999
         
-        if session_status["running"]:
-            return JSONResponse({
+        if session_lock.locked():
+            return ORJSONResponse({
                 "status": "error",
                 "message": "Session already running!"
             })
         
-        # --- ROBUST PARSER ---
-        # Use findall to extract all URLs first
-        link_pattern = r'https?://(?:twitter|x)\.com/[^ \n\r\t]+(?:/status/\d+)?(?:(?:\?|#)\S+)?|https?://t\.co/\S+'
+        # Reject before parsing/starting anything once today's cap is used up (count is cached)
+        if agent.db.get_today_reply_count() >= Config.DAILY_REPLY_LIMIT:
+            return ORJSONResponse({
+                "status": "error",
+                "message": f"Daily limit ({Config.DAILY_REPLY_LIMIT}) already reached!"
+            }, status_code=429)
         
-        # Find all URLs
-        urls_found = re.findall(link_pattern, post_urls)
+        # --- ROBUST PARSER ---
+        # One pass over the text: each URL's context is the text between its neighbouring URLs.
+        # Links never span a newline, so only lines containing "http" go through the regex
+        # (the pasted @handle lists are skipped with a cheap substring check).
+        matches = []
+        if 'http' in post_urls:
+            line_start = 0
+            for line in post_urls.split('\n'):
+                line_end = line_start + len(line)
+                if 'http' in line:
+                    matches.extend(LINK_RE.finditer(post_urls, line_start, line_end))
+                line_start = line_end + 1
         
-        if not urls_found:
-            return JSONResponse({
+        if not matches:
+            return ORJSONResponse({
                 "status": "error",
                 "message": "No valid X/Twitter URLs found in the text!"
             })
         
-        # Split by URLs to get surrounding text
-        text_parts = re.split(link_pattern, post_urls)
-        
         session_data = []
-        for idx, url in enumerate(urls_found):
-            url = url.strip()
-            # Text before this URL
-            text_before = text_parts[idx].strip() if idx < len(text_parts) else ""
-            # Text after this URL  
-            text_after = text_parts[idx + 1].strip() if idx + 1 < len(text_parts) else ""
+        last_end = 0
+        for idx, match in enumerate(matches):
+            url = match.group().strip()
+            next_start = matches[idx + 1].start() if idx + 1 < len(matches) else len(post_urls)
+            # Text before and after this URL
+            text_before = post_urls[last_end:match.start()].strip()
+            text_after = post_urls[match.end():next_start].strip()
+            last_end = match.end()
             
             # Combine and clean
             combined_context = f"{text_before}\n{text_after}".strip()
             # Clean common "Grokisms"
-            combined_context = re.sub(r'(?:ne )?post (?:kiya|ha?i):?\s*', '', combined_context, flags=re.IGNORECASE)
-            combined_context = combined_context.strip().strip('"').strip("'")
+            combined_context = GROKISM_RE.sub('', combined_context)
+            combined_context = combined_context.strip(' \t\n\r"\'').strip()
             
-            session_data.append({'url': url, 'content': combined_context})
+            session_data.append(Post(url=url, content=combined_context))
         
-        # Run in background thread
-        def run_in_background():
-            global session_status
-            session_status["running"] = True
-            session_status["progress"] = "Starting..."
-            session_status["progress_log"] = []
-            
-            def progress_callback(msg):
-                session_status["progress_log"].append(msg)
-                session_status["progress"] = msg
-            
-            try:
-                report = agent.run_session(session_data, target_count, progress_callback)
-
-                session_status["report"] = report
-                if report.get("status") == "stopped":
-                    session_status["progress"] = "🛑 Stopped by user"
-                else:
-                    session_status["progress"] = "Completed!"
-            except Exception as e:
-                session_status["report"] = {
-                    "status": "error",
-                    "message": str(e)
-                }
-                session_status["progress_log"].append(f"❌ Error: {str(e)}")
-            finally:
-                session_status["running"] = False
-        
-        thread = threading.Thread(target=run_in_background)
-        thread.start()
+        # Mark running before the task starts so early /ws/status clients never see a stale report
+        await session_lock.acquire()  # Free (checked above, no await since); released by run_session_task
+        session_status["progress_log"].clear()  # Clear in place to keep the deque's maxlen
+        session_status.update(running=True, report=None, progress="Starting...")
+        session_task = asyncio.create_task(run_session_task(agent, session_data, target_count))
         
-        return JSONResponse({
+        return ORJSONResponse({
             "status": "success",
             "message": "Session started! Check /status for updates."
         })
     except Exception as e:
         # Catch-all: ALWAYS return valid JSON, never a raw 500
-        return JSONResponse(
+        return ORJSONResponse(
             {"status": "error", "message": f"Server error: {str(e)}"},
             status_code=500
         )
 
+@app.websocket("/ws/status")
+async def status_websocket(websocket: WebSocket):
+    """Push session progress to the UI as it happens (replaces polling /status)."""
+    await websocket.accept()
+    async with ws_clients_lock:
+        ws_clients.add(websocket)
+        await websocket.send_json(status_snapshot())
+    try:
+        while True:
+            await websocket.receive_text()  # Keep-alive; clients don't send anything meaningful
+    except WebSocketDisconnect:
+        pass
+    finally:
+        async with ws_clients_lock:
+            ws_clients.discard(websocket)
+
 @app.get("/status")
 async def get_status():
-    """Get current session status."""
+    """Get current session status (polling fallback for curl/healthchecks)."""
     try:
-        return JSONResponse(session_status)
+        return ORJSONResponse({**session_status, "progress_log": list(session_status["progress_log"])})
     except Exception as e:
-        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+        return ORJSONResponse({"status": "error", "message": str(e)}, status_code=500)
 
 @app.get("/history")
 async def get_history():
     """Get reply history for the last 3 days."""
     try:
-        history = db.get_history(days=3)
-        return JSONResponse(history)
+        history = get_db().get_history(days=3)
+        return ORJSONResponse(history)
     except Exception as e:
-        return JSONResponse([], status_code=200)  # Return empty list on error
+        return ORJSONResponse([], status_code=200)  # Return empty list on error
 
 @app.post("/stop")
 async def stop_automation():
     """Stop the running automation session."""
     try:
-        global agent
         if session_status["running"]:
-            agent.stop_requested = True
-            return JSONResponse({
+            get_agent().stop_requested = True
+            return ORJSONResponse({
                 "status": "success",
                 "message": "🛑 Stop signal sent. Bot will wrap up in 1-2 seconds."
             })
         else:
-            return JSONResponse({
+            return ORJSONResponse({
                 "status": "error",
                 "message": "No session is currently running."
             })
     except Exception as e:
-        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+        return ORJSONResponse({"status": "error", "message": str(e)}, status_code=500)
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint — verifies all components are alive."""
     health = {"status": "ok", "checks": {}}
     try:
-        db.get_today_reply_count()
+        get_db().get_today_reply_count()
         health["checks"]["database"] = "ok"
     except Exception as e:
         health["checks"]["database"] = f"error: {str(e)}"
@@ -297,8 +463,9 @@ async def health_check():
     except Exception as e:
         health["checks"]["config"] = f"error: {str(e)}"
         health["status"] = "degraded"
-    health["checks"]["agent"] = "ok" if agent else "error: not initialized"
-    return JSONResponse(health)
+    # The agent is created lazily on the first /run; not having one yet is healthy
+    health["checks"]["agent"] = "ok" if _agent is not None else "not started"
+    return ORJSONResponse(health)
 
 if __name__ == "__main__":
     import os
@@ -312,7 +479,7 @@ if __name__ == "__main__":
         print("Application will start but might fail during automation runs.")
         
     try:
-        db.cleanup_old_data(days=3)
+        get_db().cleanup_old_data(days=3)
         print("✅ Database cleanup completed.")
     except Exception as e:
         print(f"⚠️ Database Error: {e}")
@@ -2,19 +2,43 @@
 Main Agent - Orchestrates the entire reply automation workflow.
 """
 import time
+import math
 import random
+import hashlib
+from collections import namedtuple
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Optional
 from .database import Database
 from .twitter_client import TwitterClient
 from .llm_client import LLMClient
+from .rate_limiter import RateLimiter
 from .config import Config
 
+ESTIMATED_REPLY_TOKENS = 300  # System + user prompt + max_tokens completion
+
+# One parsed item from the /run input: post URL + the text pasted around it
+Post = namedtuple('Post', ['url', 'content'])
+
+# Progress log timestamps are only re-formatted when the second changes
+_last_ts_second = 0
+_last_ts_str = ""
+
+def _timestamp() -> str:
+    """Current time as HH:MM:SS, formatted at most once per second."""
+    global _last_ts_second, _last_ts_str
+    now = int(time.time())
+    if now != _last_ts_second:
+        _last_ts_str = time.strftime("%H:%M:%S", time.localtime(now))
+        _last_ts_second = now
+    return _last_ts_str
+
 class Agent:
-    def __init__(self):
-        self.db = Database()
-        self.twitter = TwitterClient()
+    def __init__(self, db: Optional[Database] = None):
+        self.db = db or Database()
+        # Retry waits go through interruptible_sleep so Stop also cuts short a rate-limit cooldown
+        self.twitter = TwitterClient(sleep=self.interruptible_sleep)
         self.llm = LLMClient()
+        self.rate_limiter = RateLimiter(Config.RPM_LIMIT, Config.TPM_LIMIT)
         self.stop_requested = False
         self.session_start_time = None
 
@@ -26,18 +50,46 @@ class Agent:
             time.sleep(1)
         return False
 
-    def run_session(self, session_data: List[Dict], target_count: int, progress_callback=None) -> Dict:
+    def _generate_reply(self, tweet_text: str) -> Optional[str]:
+        """
+        generate_unique_reply behind the SQLite llm_cache (1-day TTL), keyed on the tweet text and model settings.
+        CACHE_POLICY: enabled (reuse cached replies), replay (cache only, LookupError on a miss
+        or when the cached reply is too similar to today's), disabled.
+        """
+        policy = Config.CACHE_POLICY
+        if policy == "disabled":
+            return self.llm.generate_unique_reply(tweet_text, self.db.get_similar_replies)
+        
+        key = hashlib.blake2b(f"{tweet_text}|{self.llm.model}|{self.llm.temperature}".encode(),
+                              digest_size=16).hexdigest()
+        cached = self.db.get_cached_reply(key)
+        if policy == "replay":
+            if cached is None:
+                raise LookupError("No cached reply for this tweet (CACHE_POLICY=replay)")
+            if self.llm.is_too_similar(cached, self.db.get_similar_replies(cached)):
+                raise LookupError("Cached reply is too similar to today's replies (CACHE_POLICY=replay)")
+            return cached
+        
+        # A cached reply must still pass today's similarity check
+        if cached and not self.llm.is_too_similar(cached, self.db.get_similar_replies(cached)):
+            return cached
+        
+        reply = self.llm.generate_unique_reply(tweet_text, self.db.get_similar_replies)
+        if reply:
+            self.db.cache_reply(key, reply)
+        return reply
+
+    def run_session(self, session_data: List[Post], target_count: int, progress_callback=None) -> Dict:
         """
         Run a reply session for the given data (URL + optional content).
         Returns a report of the session.
-        session_data: List of dicts like {'url': '...', 'content': '...'}
+        session_data: List of Post(url='...', content='...')
         """
         self.stop_requested = False  # Reset stop flag
         self.session_start_time = datetime.now()
         
         def log_progress(msg):
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            timestamped_msg = f"[{timestamp}] {msg}"
+            timestamped_msg = f"[{_timestamp()}] {msg}"
             if progress_callback:
                 progress_callback(timestamped_msg)
             print(timestamped_msg)
@@ -74,10 +126,11 @@ class Agent:
         
         processed = 0
         batch_count = 0
+        jitter_due = False  # Add a random human delay before the next reply after each success
         
         for i, item in enumerate(session_data):
-            url = item['url']
-            provided_content = item.get('content', '')
+            url = item.url
+            provided_content = item.content
 
             # Check if stop was requested
             if self.stop_requested:
@@ -101,8 +154,25 @@ class Agent:
                     report["stopped_by_user"] = True
                     break
             
+            # Pace replies: reserve from the token bucket before posting. Generation and
+            # posting time since the last reservation already counts toward the wait.
+            delay = self.rate_limiter.acquire(ESTIMATED_REPLY_TOKENS)
+            if jitter_due:
+                delay += random.uniform(0, Config.REPLY_JITTER)
+                jitter_due = False
+            if delay >= 1:
+                log_progress(f"⏳ Pacing: {math.ceil(delay)} seconds until next reply...")
+                if self.interruptible_sleep(math.ceil(delay)):
+                    log_progress("🛑 Stop requested during delay.")
+                    self.rate_limiter.refund(ESTIMATED_REPLY_TOKENS)
+                    report["stopped_by_user"] = True
+                    break
+            
             # Process single post
             result = self._process_single_post(url, provided_content, log_progress)
+            if result["status"] != "success":
+                # Only posted replies count toward the budget
+                self.rate_limiter.refund(ESTIMATED_REPLY_TOKENS)
             
             if result["status"] == "success":
                 report["total_replies"] += 1
@@ -111,16 +181,12 @@ class Agent:
                 batch_count += 1
                 
                 log_progress(f"✅ Success! ({processed}/{actual_target} completed)")
-                
-                # Human delay between replies
-                if processed < actual_target:
-                    delay = random.randint(Config.REPLY_DELAY_MIN, Config.REPLY_DELAY_MAX)
-                    log_progress(f"⏳ Human delay: {delay} seconds...")
-                    if self.interruptible_sleep(delay):
-                        log_progress("🛑 Stop requested during delay.")
-                        report["stopped_by_user"] = True
-                        break
+                jitter_due = True
             
+            elif result["status"] == "stopped":
+                log_progress("🛑 Stop requested while posting.")
+                report["stopped_by_user"] = True
+                break
             elif result["status"] == "skipped":
                 report["skipped"] += 1
                 log_progress(f"⏭️ Skipped: {result.get('reason', 'Unknown')}")
@@ -169,6 +235,8 @@ class Agent:
             tweet_data = self.twitter.get_tweet(tweet_id)
             
             if not tweet_data or not tweet_data.get('text'):
+                if self.stop_requested:
+                    return {"status": "stopped"}  # Stop cut the retry wait short
                 log(f"⚠️ Cannot read tweet content (API limitation)")
                 log(f"💡 SKIP: Need text content to generate quality reply")
                 return {"status": "skipped", "reason": "cannot_read_tweet_text"}
@@ -182,9 +250,13 @@ class Agent:
             return {"status": "skipped", "reason": "content_too_short"}
         
         # Generate reply
-        previous_replies = self.db.get_todays_replies()
         log(f"🤖 Generating reply...")
-        reply_text = self.llm.generate_unique_reply(tweet_text, previous_replies)
+        try:
+            reply_text = self._generate_reply(tweet_text)
+        except LookupError as e:
+            # Replay mode has no usable cached reply: fail this post, not the session
+            log(f"❌ {e}")
+            return {"status": "failed", "error": str(e)}
         
         if not reply_text:
             log(f"❌ Failed to generate reply")
@@ -203,11 +275,13 @@ class Agent:
         
         if success:
             # Save to database
-            self.db.mark_post_processed(url, tweet_id, reply_text)
-            self.db.increment_daily_count()
-            self.db.save_todays_reply(reply_text)
+            self.db.record_success(url, tweet_id, reply_text)
             log(f"✅ Posted successfully!")
             return {"status": "success", "reply": reply_text}
+        elif self.stop_requested:
+            # Stop cut a retry wait or rate limit cooldown short; not a posting failure
+            log(f"🛑 Posting interrupted by stop request")
+            return {"status": "stopped"}
         else:
             log(f"❌ Failed to post: {error_detail}")
             return {"status": "failed", "error": error_detail or "Twitter API error"}
@@ -6,6 +6,11 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Pre-token-bucket settings (seconds between replies), still honored as fallbacks:
+# REPLY_DELAY_MIN sets the default RPM_LIMIT, MAX - MIN the default REPLY_JITTER
+_REPLY_DELAY_MIN = int(os.getenv("REPLY_DELAY_MIN", 60))
+_REPLY_DELAY_MAX = int(os.getenv("REPLY_DELAY_MAX", 180))
+
 class Config:
     # X API Credentials
     X_API_KEY = os.getenv("X_API_KEY")
@@ -19,19 +24,26 @@ class Config:
     
     # App Settings
     DAILY_REPLY_LIMIT = int(os.getenv("DAILY_REPLY_LIMIT", 50))
-    REPLY_DELAY_MIN = int(os.getenv("REPLY_DELAY_MIN", 60))
-    REPLY_DELAY_MAX = int(os.getenv("REPLY_DELAY_MAX", 180))
+    # Replies per minute (token bucket, 0 = no limit)
+    RPM_LIMIT = float(os.getenv("RPM_LIMIT", 60 / _REPLY_DELAY_MIN if _REPLY_DELAY_MIN > 0 else 0))
+    TPM_LIMIT = int(os.getenv("TPM_LIMIT", 10000))  # LLM tokens per minute (token bucket, 0 = no limit)
+    # Random extra 0..REPLY_JITTER seconds between replies so they don't go out on a fixed cadence
+    REPLY_JITTER = int(os.getenv("REPLY_JITTER", max(_REPLY_DELAY_MAX - _REPLY_DELAY_MIN, 0)))
     BATCH_SIZE = int(os.getenv("BATCH_SIZE", 10))
     BATCH_BREAK_MIN = int(os.getenv("BATCH_BREAK_MIN", 180))  # 3 minutes
     BATCH_BREAK_MAX = int(os.getenv("BATCH_BREAK_MAX", 300))  # 5 minutes
+    CACHE_POLICY = os.getenv("CACHE_POLICY", "enabled")  # enabled | replay | disabled (LLM reply cache)
+    
+    # (name, value) pairs checked by validate(), captured once at class definition
+    _REQUIRED = (
+        ("X_API_KEY", X_API_KEY), ("X_API_KEY_SECRET", X_API_KEY_SECRET),
+        ("X_ACCESS_TOKEN", X_ACCESS_TOKEN), ("X_ACCESS_TOKEN_SECRET", X_ACCESS_TOKEN_SECRET),
+        ("OPENAI_API_KEY", OPENAI_API_KEY)
+    )
     
     @classmethod
     def validate(cls):
         """Validate that all required configs are set."""
-        required = [
-            "X_API_KEY", "X_API_KEY_SECRET", "X_ACCESS_TOKEN", 
-            "X_ACCESS_TOKEN_SECRET", "OPENAI_API_KEY"
-        ]
-        missing = [key for key in required if not getattr(cls, key)]
+        missing = [name for name, value in cls._REQUIRED if not value]
         if missing:
             raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
@@ -2,179 +2,320 @@
 Database module for tracking processed posts and daily statistics.
 """
 import sqlite3
-from datetime import datetime, date
-from typing import List, Optional
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta, timezone
+from typing import Iterable, List, Optional, Set, Tuple
 import os
 
+# Statements used on every request/post, defined once so the text handed to
+# sqlite3's prepared-statement cache is identical on every call
+SQL_GET_SETTING = "SELECT value FROM settings WHERE key = ?"
+SQL_SET_SETTING = "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)"
+SQL_PROCESSED_URLS = "SELECT post_url FROM processed_posts"
+SQL_INSERT_POST = "INSERT OR IGNORE INTO processed_posts (post_url, post_id, reply_text) VALUES (?, ?, ?)"
+SQL_INC_DAILY = "INSERT INTO daily_stats (date, reply_count) VALUES (?, 1) ON CONFLICT(date) DO UPDATE SET reply_count = reply_count + 1"
+SQL_GET_DAILY = "SELECT reply_count FROM daily_stats WHERE date = ?"
+SQL_INSERT_TODAYS_REPLY = "INSERT INTO todays_replies (reply_text) VALUES (?)"
+# timestamp columns hold UTC 'YYYY-MM-DD HH:MM:SS' text, so "today" is a range on the raw column (index-friendly)
+SQL_TODAYS_REPLIES = "SELECT reply_text FROM todays_replies WHERE timestamp >= date('now')"
+SQL_SIMILAR_REPLIES = """
+    SELECT r.reply_text
+    FROM todays_replies_fts JOIN todays_replies r ON r.id = todays_replies_fts.rowid
+    WHERE todays_replies_fts MATCH ? AND r.timestamp >= date('now')
+"""
+SQL_GET_LLM_CACHE = "SELECT reply FROM llm_cache WHERE hash = ? AND ts > datetime('now', ?)"
+SQL_SET_LLM_CACHE = "INSERT OR REPLACE INTO llm_cache (hash, reply) VALUES (?, ?)"
+SQL_HISTORY = """
+    SELECT post_url, reply_text, timestamp 
+    FROM processed_posts 
+    WHERE timestamp >= ? 
+    ORDER BY timestamp DESC
+"""
+
+def _utc_cutoff(days: int) -> str:
+    """UTC time `days` ago, formatted like CURRENT_TIMESTAMP for direct comparison."""
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
 class Database:
+    # DB files already switched to WAL by this process (journal_mode persists in the file)
+    _wal_enabled_paths = set()
+
     def __init__(self, db_path: str = "automation.db"):
         self.db_path = db_path
+        # Today's reply count, cached so limit checks don't re-query SQLite
+        self._count_date = None
+        self._today_count = 0
+        # Today's ISO date, recomputed only once local midnight has passed
+        self._today_str = None
+        self._day_ends_at = 0.0
+        # One connection for the app's lifetime keeps SQLite's page cache warm.
+        # The UI and the worker thread share it, so every use holds the lock.
+        self._conn = self._connect()
+        self._lock = threading.RLock()
+        self._fts_enabled = False
         self.init_db()
+        # Replied-to URLs cached in memory; SQLite stays the source of truth
+        self._processed_urls = self.get_processed_urls()
     
+    def _connect(self) -> sqlite3.Connection:
+        """Open an autocommit connection tuned for this write-heavy workload."""
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False,
+                               cached_statements=128)
+        if self.db_path != ":memory:":
+            # WAL: readers don't block on writes and commits fsync less. Persistent, so once per process.
+            if self.db_path not in Database._wal_enabled_paths:
+                conn.execute("PRAGMA journal_mode=WAL")
+                Database._wal_enabled_paths.add(self.db_path)
+            # Per-connection settings
+            conn.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL; no fsync per commit
+            conn.execute("PRAGMA wal_autocheckpoint=1000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")  # ~64 MB page cache
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Run a block of statements as one BEGIN ... COMMIT (rolled back on error)."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _today(self) -> str:
+        """Today's date as YYYY-MM-DD (cached until local midnight)."""
+        if time.time() >= self._day_ends_at:
+            today = date.today()
+            self._today_str = today.isoformat()
+            self._day_ends_at = datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
+        return self._today_str
+
+    def close(self):
+        """Close the shared connection (checkpoints the WAL)."""
+        with self._lock:
+            self._conn.close()
+
     def init_db(self):
         """Initialize database tables if they don't exist."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Table for processed posts (Detailed History)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS processed_posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_url TEXT UNIQUE NOT NULL,
-                post_id TEXT NOT NULL,
-                reply_text TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Table for daily statistics
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS daily_stats (
-                date DATE PRIMARY KEY,
-                reply_count INTEGER DEFAULT 0
-            )
-        """)
-        
-        # Table for today's posted replies (for similarity check)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS todays_replies (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                reply_text TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        with self._lock:
+            cursor = self._conn.cursor()
+            
+            # Table for processed posts (Detailed History)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS processed_posts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    post_url TEXT UNIQUE NOT NULL,
+                    post_id TEXT NOT NULL,
+                    reply_text TEXT,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # get_history and cleanup filter/sort on timestamp
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_posts_timestamp ON processed_posts(timestamp)")
+            
+            # Table for daily statistics
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS daily_stats (
+                    date DATE PRIMARY KEY,
+                    reply_count INTEGER DEFAULT 0
+                )
+            """)
+            
+            # Table for today's posted replies (for similarity check)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS todays_replies (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    reply_text TEXT NOT NULL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_todays_replies_timestamp ON todays_replies(timestamp)")
+            
+            # Trigram index over todays_replies, kept in sync by triggers, so the
+            # similarity check only fetches replies that share words with a new one
+            try:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'todays_replies_fts'")
+                fts_is_new = cursor.fetchone() is None
+                cursor.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS todays_replies_fts USING fts5(
+                        reply_text, content='todays_replies', content_rowid='id', tokenize='trigram'
+                    )
+                """)
+                cursor.execute("""
+                    CREATE TRIGGER IF NOT EXISTS todays_replies_ai AFTER INSERT ON todays_replies BEGIN
+                        INSERT INTO todays_replies_fts (rowid, reply_text) VALUES (new.id, new.reply_text);
+                    END
+                """)
+                cursor.execute("""
+                    CREATE TRIGGER IF NOT EXISTS todays_replies_ad AFTER DELETE ON todays_replies BEGIN
+                        INSERT INTO todays_replies_fts (todays_replies_fts, rowid, reply_text)
+                        VALUES ('delete', old.id, old.reply_text);
+                    END
+                """)
+                if fts_is_new:
+                    # Index replies saved before the FTS table existed
+                    cursor.execute("INSERT INTO todays_replies_fts (todays_replies_fts) VALUES ('rebuild')")
+                self._fts_enabled = True
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5 or older than 3.34 (no trigram tokenizer)
+                self._fts_enabled = False
 
-        # Table for generic settings (persistent config)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+            # Table for generic settings (persistent config)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+            
+            # Generated replies keyed by a hash of the tweet text and model settings
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    hash TEXT PRIMARY KEY,
+                    reply TEXT NOT NULL,
+                    ts DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Migration: older databases lack the reply_text column (checked once, not per insert)
+            cursor.execute("PRAGMA table_info(processed_posts)")
+            columns = [col[1] for col in cursor.fetchall()]
+            if 'reply_text' not in columns:
+                cursor.execute("ALTER TABLE processed_posts ADD COLUMN reply_text TEXT")
 
     def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
         """Retrieve a persistent setting."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-        row = cursor.fetchone()
-        conn.close()
+        with self._lock:
+            row = self._conn.execute(SQL_GET_SETTING, (key,)).fetchone()
         return row[0] if row else default
 
     def set_setting(self, key: str, value: str):
         """Save or update a persistent setting."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)
-        ''', (key, value))
-        conn.commit()
-        conn.close()
+        with self._lock:
+            self._conn.execute(SQL_SET_SETTING, (key, value))
 
     def is_post_processed(self, post_url: str) -> bool:
-        """Check if a post has already been replied to."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM processed_posts WHERE post_url = ?", (post_url,))
-        result = cursor.fetchone()
-        conn.close()
-        return result is not None
+        """Check if a post has already been replied to (in-memory lookup)."""
+        return post_url in self._processed_urls
+    
+    def get_processed_urls(self) -> Set[str]:
+        """Load every post URL already replied to from the database."""
+        with self._lock:
+            results = self._conn.execute(SQL_PROCESSED_URLS).fetchall()
+        return {r[0] for r in results}
     
     def mark_post_processed(self, post_url: str, post_id: str, reply_text: str = None):
-        """Mark a post as processed with reply text."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            # Check if columns exist (for migration)
-            cursor.execute("PRAGMA table_info(processed_posts)")
-            columns = [col[1] for col in cursor.fetchall()]
-            if 'reply_text' not in columns:
-                cursor.execute("ALTER TABLE processed_posts ADD COLUMN reply_text TEXT")
-            
-            cursor.execute(
-                "INSERT INTO processed_posts (post_url, post_id, reply_text) VALUES (?, ?, ?)",
-                (post_url, post_id, reply_text)
-            )
-            conn.commit()
-        except sqlite3.IntegrityError:
-            pass  # Already exists
-        finally:
-            conn.close()
+        """Mark a post as processed with reply text (no-op if it already exists)."""
+        self.mark_posts_processed([(post_url, post_id, reply_text)])
+    
+    def mark_posts_processed(self, rows: Iterable[Tuple[str, str, Optional[str]]]):
+        """Mark many (post_url, post_id, reply_text) rows as processed in a single transaction."""
+        rows = list(rows)
+        with self._transaction() as conn:
+            conn.executemany(SQL_INSERT_POST, rows)
+        self._processed_urls.update(row[0] for row in rows)
+    
+    def record_success(self, post_url: str, post_id: str, reply_text: str):
+        """Record a posted reply (processed post, daily count, today's replies) in one transaction."""
+        today = self._today()
+        with self._transaction() as conn:
+            conn.execute(SQL_INSERT_POST, (post_url, post_id, reply_text))
+            conn.execute(SQL_INC_DAILY, (today,))
+            conn.execute(SQL_INSERT_TODAYS_REPLY, (reply_text,))
+        self._processed_urls.add(post_url)
+        if self._count_date == today:
+            self._today_count += 1
     
     def get_history(self, days: int = 3) -> List[dict]:
         """Fetch reply history for the last X days."""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT post_url, reply_text, timestamp 
-            FROM processed_posts 
-            WHERE timestamp >= datetime('now', ?) 
-            ORDER BY timestamp DESC
-        """, (f'-{days} days',))
-        rows = cursor.fetchall()
-        conn.close()
-        return [dict(row) for row in rows]
+        with self._lock:
+            rows = self._conn.execute(SQL_HISTORY, (_utc_cutoff(days),)).fetchall()
+        return [
+            {'post_url': url, 'reply_text': reply, 'timestamp': ts}
+            for url, reply, ts in rows
+        ]
 
     def cleanup_old_data(self, days: int = 3):
-        """Delete data older than X days to keep DB smooth."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Clean processed posts history
-        cursor.execute("DELETE FROM processed_posts WHERE timestamp < datetime('now', ?)", (f'-{days} days',))
-        # Clean daily stats (keep a bit longer, maybe 7 days, but user asked for 1-3)
-        cursor.execute("DELETE FROM daily_stats WHERE date < date('now', ?)", (f'-{days} days',))
-        # Todays replies is already cleaned daily
-        cursor.execute("DELETE FROM todays_replies WHERE timestamp < datetime('now', ?)", (f'-{days} days',))
-        conn.commit()
-        conn.close()
+        """Delete data older than X days to keep DB smooth (one transaction for all tables)."""
+        cutoff = _utc_cutoff(days)
+        with self._transaction() as conn:
+            # Clean processed posts history
+            conn.execute("DELETE FROM processed_posts WHERE timestamp < ?", (cutoff,))
+            # Clean daily stats (keep a bit longer, maybe 7 days, but user asked for 1-3)
+            conn.execute("DELETE FROM daily_stats WHERE date < date('now', ?)", (f'-{days} days',))
+            # Todays replies is already cleaned daily
+            conn.execute("DELETE FROM todays_replies WHERE timestamp < ?", (cutoff,))
+            # Cached LLM replies expire after a day anyway
+            conn.execute("DELETE FROM llm_cache WHERE ts < datetime('now', '-1 day')")
+            self._processed_urls = self.get_processed_urls()
 
     def get_today_reply_count(self) -> int:
-        """Get the number of replies posted today."""
-        today = date.today()
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT reply_count FROM daily_stats WHERE date = ?", (today,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else 0
+        """Get the number of replies posted today (cached; reloaded when the date changes)."""
+        today = self._today()
+        if self._count_date != today:
+            with self._lock:
+                result = self._conn.execute(SQL_GET_DAILY, (today,)).fetchone()
+            self._today_count = result[0] if result else 0
+            self._count_date = today
+        return self._today_count
     
     def increment_daily_count(self):
         """Increment today's reply count."""
-        today = date.today()
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO daily_stats (date, reply_count) VALUES (?, 1) ON CONFLICT(date) DO UPDATE SET reply_count = reply_count + 1",
-            (today,)
-        )
-        conn.commit()
-        conn.close()
+        today = self._today()
+        with self._lock:
+            self._conn.execute(SQL_INC_DAILY, (today,))
+        if self._count_date == today:
+            self._today_count += 1
     
     def save_todays_reply(self, reply_text: str):
         """Save a reply to today's replies for similarity checking."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO todays_replies (reply_text) VALUES (?)", (reply_text,))
-        conn.commit()
-        conn.close()
+        self.save_todays_replies([reply_text])
+    
+    def save_todays_replies(self, replies: Iterable[str]):
+        """Save many replies to today's replies in a single transaction."""
+        with self._transaction() as conn:
+            conn.executemany(SQL_INSERT_TODAYS_REPLY, ((r,) for r in replies))
     
     def get_todays_replies(self) -> List[str]:
         """Get all replies posted today."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT reply_text FROM todays_replies WHERE DATE(timestamp) = DATE('now')")
-        results = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            results = self._conn.execute(SQL_TODAYS_REPLIES).fetchall()
+        return [r[0] for r in results]
+    
+    def get_cached_reply(self, key: str, max_age_days: int = 1) -> Optional[str]:
+        """Look up a generated reply cached within the last max_age_days."""
+        with self._lock:
+            row = self._conn.execute(SQL_GET_LLM_CACHE, (key, f'-{max_age_days} days')).fetchone()
+        return row[0] if row else None
+    
+    def cache_reply(self, key: str, reply: str):
+        """Store (or refresh) a generated reply in the LLM cache."""
+        with self._lock:
+            self._conn.execute(SQL_SET_LLM_CACHE, (key, reply))
+    
+    def get_similar_replies(self, reply_text: str, threshold: float = 0.6) -> List[str]:
+        """
+        Today's replies that could be too similar to reply_text: those containing one of
+        its words of 3+ characters. Falls back to all of today's replies when the index is
+        unavailable or short words alone could push word-set similarity past threshold.
+        """
+        words = set(reply_text.lower().split())
+        if not words:
+            return []
+        long_words = [w for w in words if len(w) >= 3]
+        if not self._fts_enabled or len(words) - len(long_words) > threshold * len(words):
+            return self.get_todays_replies()
+        query = " OR ".join('"' + w.replace('"', '""') + '"' for w in long_words)
+        with self._lock:
+            results = self._conn.execute(SQL_SIMILAR_REPLIES, (query,)).fetchall()
         return [r[0] for r in results]
     
     def clear_old_daily_replies(self):
         """Clear replies older than today (run at startup)."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM todays_replies WHERE DATE(timestamp) < DATE('now')")
-        conn.commit()
-        conn.close()
+        with self._lock:
+            self._conn.execute("DELETE FROM todays_replies WHERE timestamp < date('now')")
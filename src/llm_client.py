@@ -1,14 +1,20 @@
 """
 LLM Client for generating human-style replies using OpenAI.
 """
-from openai import OpenAI
+from openai import AsyncOpenAI
 from .config import Config
-from typing import List
-import difflib
+from typing import Callable, FrozenSet, Iterable, List
+import asyncio
+import re
+import threading
+
+# Leading/trailing whitespace and stray quotes around a generated reply
+_TRIM_RE = re.compile(r'^[\s"\']+|[\s"\']+$')
 
 class LLMClient:
     def __init__(self):
-        self.client = OpenAI(api_key=Config.OPENAI_API_KEY)
+        self.model = "gpt-4o-mini"
+        self.temperature = 0.9  # High temp for variety
         self.system_prompt = """You are a helpful Twitter user who writes thoughtful, natural replies.
 
 Rules:
@@ -22,9 +28,46 @@ Rules:
 - NO long dashes (—)
 - NO generic praise like "Great post!" or "Amazing!"
 - Sound like a real human, not a bot"""
+        # One event loop and one AsyncOpenAI client for the client's lifetime, created on
+        # first use. The HTTP pool is bound to the loop, so keeping both keeps connections warm.
+        self._runner = None
+        self._client = None
+        self._runner_lock = threading.Lock()  # A loop can't run twice at once
+    
+    def _run(self, coro):
+        """Run a coroutine on this client's long-lived event loop."""
+        with self._runner_lock:
+            if self._runner is None:
+                # Build the client first so a failure (e.g. missing API key) leaves nothing
+                # half set up and the next call retries with the original error
+                try:
+                    client = AsyncOpenAI(api_key=Config.OPENAI_API_KEY)
+                except BaseException:
+                    coro.close()
+                    raise
+                self._runner = asyncio.Runner()
+                self._client = client
+            return self._runner.run(coro)
+    
+    def close(self):
+        """Close the HTTP client and its event loop."""
+        with self._runner_lock:
+            if self._runner is None:
+                return
+            self._runner.run(self._client.close())
+            self._runner.close()
+            self._runner = None
+            self._client = None
     
     def generate_reply(self, tweet_text: str, previous_replies: List[str] = None) -> str:
         """Generate a reply for the given tweet."""
+        return self._run(self._generate_reply_once(tweet_text))
+    
+    async def _generate_reply_once(self, tweet_text: str) -> str:
+        return await self.generate_reply_async(self._client, tweet_text)
+    
+    async def generate_reply_async(self, client: AsyncOpenAI, tweet_text: str) -> str:
+        """Generate a reply for the given tweet using an open async client."""
         user_prompt = f"""Write a brief, thoughtful reply to this tweet:
 
 "{tweet_text}"
@@ -32,20 +75,18 @@ Rules:
 Remember: Under 220 chars, no emoji, sound natural and human."""
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
+            response = await client.chat.completions.create(
+                model=self.model,
                 messages=[
                     {"role": "system", "content": self.system_prompt},
                     {"role": "user", "content": user_prompt}
                 ],
                 max_tokens=100,
-                temperature=0.9  # High temp for variety
+                temperature=self.temperature
             )
             
-            reply = response.choices[0].message.content.strip()
-            
-            # Remove any accidental quotes
-            reply = reply.strip('"').strip("'")
+            # Remove whitespace and any accidental quotes in one pass
+            reply = _TRIM_RE.sub('', response.choices[0].message.content)
             
             # Check length
             if len(reply) > 220:
@@ -56,27 +97,60 @@ Remember: Under 220 chars, no emoji, sound natural and human."""
             print(f"Error generating reply: {e}")
             return None
     
-    def is_too_similar(self, new_reply: str, previous_replies: List[str], threshold: float = 0.6) -> bool:
-        """Check if the new reply is too similar to previous ones."""
-        if not previous_replies:
-            return False
-        
-        for prev in previous_replies:
-            similarity = difflib.SequenceMatcher(None, new_reply.lower(), prev.lower()).ratio()
-            if similarity > threshold:
+    @staticmethod
+    def _token_set(text: str) -> FrozenSet[str]:
+        return frozenset(text.lower().split())
+    
+    @staticmethod
+    def _too_similar(new_set: FrozenSet[str], prev_sets: Iterable[FrozenSet[str]], threshold: float) -> bool:
+        """Word-set Jaccard similarity against each previous reply; stops at the first match."""
+        for prev in prev_sets:
+            union = len(new_set | prev)
+            if union and len(new_set & prev) / union > threshold:
                 return True
-        
         return False
     
-    def generate_unique_reply(self, tweet_text: str, previous_replies: List[str], max_attempts: int = 3) -> str:
-        """Generate a reply that's not too similar to previous ones."""
-        for attempt in range(max_attempts):
-            reply = self.generate_reply(tweet_text, previous_replies)
-            if not reply:
-                return None
-            
-            if not self.is_too_similar(reply, previous_replies):
-                return reply
+    def is_too_similar(self, new_reply: str, previous_replies: Iterable[str], threshold: float = 0.6) -> bool:
+        """Check if the new reply is too similar to previous ones (tokenized lazily, stops at the first match)."""
+        prev_sets = (self._token_set(p) for p in previous_replies)
+        return self._too_similar(self._token_set(new_reply), prev_sets, threshold)
+    
+    def generate_unique_reply(self, tweet_text: str, similar_replies: Callable[[str], Iterable[str]],
+                              max_attempts: int = 3) -> str:
+        """
+        Generate a reply that's not too similar to previous ones.
+        similar_replies(reply) returns the previous replies worth comparing against.
+        """
+        return self._run(self._generate_unique_reply_async(tweet_text, similar_replies, max_attempts))
+    
+    async def _generate_unique_reply_async(self, tweet_text: str, similar_replies: Callable[[str], Iterable[str]],
+                                           max_attempts: int) -> str:
+        def too_similar(reply: str) -> bool:
+            return self.is_too_similar(reply, similar_replies(reply))
+        
+        client = self._client
+        # First attempt alone: it usually passes, and we don't pay for spares
+        reply = await self.generate_reply_async(client, tweet_text)
+        if not reply:
+            return None
+        if max_attempts <= 1 or not too_similar(reply):
+            return reply
+        
+        # Too similar: fire the remaining attempts together, keep the first unique one
+        tasks = [asyncio.create_task(self.generate_reply_async(client, tweet_text))
+                 for _ in range(max_attempts - 1)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                candidate = await next_done
+                if not candidate:
+                    continue
+                reply = candidate
+                if not too_similar(candidate):
+                    return candidate
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
         
         # If all attempts failed, return the last one anyway
         return reply
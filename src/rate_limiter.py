@@ -0,0 +1,53 @@
+"""
+Token-bucket rate limiter for pacing replies by requests and LLM tokens per minute.
+"""
+import time
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        # A limit of 0 (or less) disables that bucket
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        # Buckets start full and refill continuously. The request bucket holds a single
+        # request, so replies never burst: reservations are always 60/rpm seconds apart.
+        # The LLM token bucket holds up to one minute's allowance.
+        self.request_capacity = 1.0
+        self.request_tokens = self.request_capacity
+        self.llm_tokens = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        """Add the allowance earned since the last refill."""
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.rpm > 0:
+            self.request_tokens = min(self.request_capacity, self.request_tokens + elapsed * self.rpm / 60)
+        if self.tpm > 0:
+            self.llm_tokens = min(self.tpm, self.llm_tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, estimated_tokens: int = 0) -> float:
+        """
+        Reserve one request and estimated_tokens LLM tokens before making the request.
+        Returns the seconds to wait before going ahead (0 while the buckets have room).
+        Time spent since the previous reservation counts toward the wait.
+        """
+        self._refill()
+        wait = 0.0
+        if self.rpm > 0:
+            self.request_tokens -= 1
+            if self.request_tokens < 0:
+                wait = -self.request_tokens * 60 / self.rpm
+        if self.tpm > 0:
+            self.llm_tokens -= estimated_tokens
+            if self.llm_tokens < 0:
+                wait = max(wait, -self.llm_tokens * 60 / self.tpm)
+        return wait
+
+    def refund(self, estimated_tokens: int = 0):
+        """Give back a reservation that wasn't used (e.g. the post was skipped)."""
+        if self.rpm > 0:
+            self.request_tokens = min(self.request_capacity, self.request_tokens + 1)
+        if self.tpm > 0:
+            self.llm_tokens = min(self.tpm, self.llm_tokens + estimated_tokens)
@@ -3,14 +3,54 @@ Twitter/X API Client wrapper using Tweepy.
 Now with auto-retry, detailed error reporting, and self-healing.
 """
 import tweepy
-from typing import Optional, Dict, Tuple
+from typing import Callable, Optional, Dict, Tuple
 import re
 import time
+from collections import namedtuple
 from .config import Config
 
+_TWEET_ID_RE = re.compile(r'(?:twitter|x)\.com/[^/]+/status/(\d+)')
+
+# Error keywords by category, matched in one pass. The lookahead makes every
+# position a candidate so overlapping keywords (e.g. "50429") are all seen.
+_ERR_RE = re.compile(
+    r'(?=(?P<rate>429|rate limit|too many)'
+    r'|(?P<server>500|502|503|504)'
+    r'|(?P<net>connection|timeout|network|reset|broken pipe)'
+    r'|(?P<auth>401|unauthorized)'
+    r'|(?P<forbid>403|forbidden)'
+    r'|(?P<dup>duplicate|already))',
+    re.IGNORECASE
+)
+
+# How to handle an error of each category
+ErrInfo = namedtuple('ErrInfo', ['retryable', 'category', 'message', 'wait_time', 'reconnect'], defaults=[False])
+
+# Shared records per _ERR_RE group, in precedence order (first match wins)
+_ERR_TABLE = {
+    # Rate limit errors — RETRYABLE (wait 3 minutes, then retry)
+    "rate": ErrInfo(True, "rate_limit", "Rate limited by Twitter.", 180),
+    # Server errors (500, 502, 503, 504) — RETRYABLE
+    "server": ErrInfo(True, "server_error", "Twitter server error. Will auto-retry.", 10),
+    # Network / connection errors — RETRYABLE
+    "net": ErrInfo(True, "network", "Network error. Will auto-retry.", 5),
+    # Auth errors (401) — TRY RECONNECT once, then permanent
+    "auth": ErrInfo(True, "auth", "Auth error (401). Attempting reconnect.", 2, reconnect=True),
+    # Forbidden (403) — permanent; message gets the error text
+    "forbid": ErrInfo(False, "forbidden", "Forbidden (403).", 0),
+    # Duplicate tweet error — SKIP (not retryable but not really an error)
+    "dup": ErrInfo(False, "duplicate", "Duplicate tweet — already posted.", 0),
+}
+_ERR_UNKNOWN = ErrInfo(True, "unknown", "Unknown error.", 5)
+
 
 class TwitterClient:
-    def __init__(self):
+    def __init__(self, sleep: Optional[Callable[[float], Optional[bool]]] = None):
+        """
+        sleep: waits between retries. Defaults to time.sleep; the agent passes its
+        interruptible sleep, which returns True once a stop was requested.
+        """
+        self.sleep = sleep or time.sleep
         self._init_client()
         self.MAX_RETRIES = 3
         self.RATE_LIMIT_RETRIES = 2  # Extra retries for rate limits
@@ -26,76 +66,23 @@ class TwitterClient:
             access_token_secret=Config.X_ACCESS_TOKEN_SECRET
         )
 
-    def _classify_error(self, error: Exception) -> Dict:
+    def _classify_error(self, error: Exception) -> ErrInfo:
         """Classify an error as retryable or permanent, with details."""
-        error_str = str(error).lower()
-        
-        # Rate limit errors — RETRYABLE (wait longer)
-        if "429" in str(error) or "rate limit" in error_str or "too many" in error_str:
-            return {
-                "retryable": True,
-                "category": "rate_limit",
-                "message": f"Rate limited by Twitter.",
-                "wait_time": 180  # Wait 3 minutes on rate limit, then retry
-            }
+        error_text = str(error)
+        found = {m.lastgroup for m in _ERR_RE.finditer(error_text)}
         
-        # Server errors (500, 502, 503, 504) — RETRYABLE
-        if any(code in str(error) for code in ["500", "502", "503", "504"]):
-            return {
-                "retryable": True,
-                "category": "server_error",
-                "message": f"Twitter server error. Will auto-retry.",
-                "wait_time": 10
-            }
-        
-        # Network / connection errors — RETRYABLE
-        if any(kw in error_str for kw in ["connection", "timeout", "network", "reset", "broken pipe"]):
-            return {
-                "retryable": True,
-                "category": "network",
-                "message": f"Network error. Will auto-retry.",
-                "wait_time": 5
-            }
-        
-        # Auth errors (401, 403) — TRY RECONNECT once, then permanent
-        if "401" in str(error) or "unauthorized" in error_str:
-            return {
-                "retryable": True,  # Try reconnecting the client once
-                "category": "auth",
-                "message": f"Auth error (401). Attempting reconnect.",
-                "wait_time": 2,
-                "reconnect": True
-            }
-        
-        if "403" in str(error) or "forbidden" in error_str:
-            return {
-                "retryable": False,
-                "category": "forbidden",
-                "message": f"Forbidden (403): {str(error)[:150]}. Check API permissions.",
-                "wait_time": 0
-            }
-        
-        # Duplicate tweet error — SKIP (not retryable but not really an error)
-        if "duplicate" in error_str or "already" in error_str:
-            return {
-                "retryable": False,
-                "category": "duplicate",
-                "message": "Duplicate tweet — already posted.",
-                "wait_time": 0
-            }
+        for group, info in _ERR_TABLE.items():
+            if group in found:
+                if group == "forbid":
+                    return info._replace(message=f"Forbidden (403): {error_text[:150]}. Check API permissions.")
+                return info
         
         # Unknown errors — retry once
-        return {
-            "retryable": True,
-            "category": "unknown",
-            "message": f"Unknown error: {str(error)[:200]}",
-            "wait_time": 5
-        }
+        return _ERR_UNKNOWN._replace(message=f"Unknown error: {error_text[:200]}")
 
     def extract_tweet_id(self, url: str) -> Optional[str]:
         """Extract tweet ID from a Twitter/X URL."""
-        pattern = r'(?:twitter|x)\.com/[^/]+/status/(\d+)'
-        match = re.search(pattern, url)
+        match = _TWEET_ID_RE.search(url)
         return match.group(1) if match else None
 
     def get_tweet(self, tweet_id: str) -> Optional[Dict]:
@@ -116,16 +103,17 @@ class TwitterClient:
             except Exception as e:
                 last_error = e
                 err_info = self._classify_error(e)
-                print(f"[Retry {attempt+1}/{self.MAX_RETRIES}] get_tweet error: {err_info['message']}")
+                print(f"[Retry {attempt+1}/{self.MAX_RETRIES}] get_tweet error: {err_info.message}")
                 
-                if err_info.get("reconnect"):
+                if err_info.reconnect:
                     print("  -> Reconnecting Twitter client...")
                     self._init_client()
                 
-                if not err_info["retryable"] or attempt == self.MAX_RETRIES - 1:
+                if not err_info.retryable or attempt == self.MAX_RETRIES - 1:
                     break
                 
-                time.sleep(err_info["wait_time"])
+                if self.sleep(err_info.wait_time):
+                    break
         
         print(f"get_tweet failed after {self.MAX_RETRIES} attempts: {last_error}")
         return None
@@ -155,7 +143,8 @@ class TwitterClient:
         if self.is_rate_limited():
             wait_secs = self.get_rate_limit_remaining()
             log(f"   ⏸️ Rate limit active. Waiting {wait_secs//60}m {wait_secs%60}s...")
-            time.sleep(wait_secs)
+            if self.sleep(wait_secs):
+                return (False, "Stopped during rate limit cooldown")
 
         last_error_msg = ""
         reconnected = False
@@ -174,29 +163,31 @@ class TwitterClient:
                     last_error_msg = "API returned empty response"
             except Exception as e:
                 err_info = self._classify_error(e)
-                last_error_msg = err_info["message"]
+                last_error_msg = err_info.message
                 log(f"   ⚠️ Attempt {attempt+1}/{max_retries}: {last_error_msg}")
                 
                 # Self-healing: reconnect on auth errors (once)
-                if err_info.get("reconnect") and not reconnected:
+                if err_info.reconnect and not reconnected:
                     log("   🔄 Reconnecting Twitter client...")
                     self._init_client()
                     reconnected = True
                 
                 # Rate limit: set cooldown and do longer wait
-                if err_info["category"] == "rate_limit":
-                    self.rate_limited_until = time.time() + err_info["wait_time"]
+                if err_info.category == "rate_limit":
+                    self.rate_limited_until = time.time() + err_info.wait_time
                     if attempt < max_retries - 1:
-                        wait_min = err_info["wait_time"] // 60
+                        wait_min = err_info.wait_time // 60
                         log(f"   ⏸️ Rate limited. Cooling down for {wait_min} minutes...")
-                        time.sleep(err_info["wait_time"])
+                        if self.sleep(err_info.wait_time):
+                            break
                         continue
                 
-                if not err_info["retryable"] or attempt == max_retries - 1:
+                if not err_info.retryable or attempt == max_retries - 1:
                     break
                 
-                wait = err_info["wait_time"]
+                wait = err_info.wait_time
                 log(f"   ⏳ Waiting {wait}s before retry...")
-                time.sleep(wait)
+                if self.sleep(wait):
+                    break
         
         return (False, last_error_msg)